@@ -5,8 +5,9 @@ BibTexのいらない項目を削除するスクリプト
 
 import sys
 import re
-import unicodedata
-from collections import Counter
+import threading
+from collections import defaultdict
+from functools import lru_cache, partial
 import bibtexparser
 from bibtexparser.bibdatabase import BibDatabase
 from bibtexparser.bparser import BibTexParser
@@ -17,6 +18,39 @@ import bibtexparser.customization as bcus
 from bibtex_schema import required as required_fields
 
 
+def _make_projector(fields):
+    """必要なフィールドだけを取り出す関数を作る
+
+    フィールドごとの判定をループで回さずに済むよう、fieldsを展開した関数のソースを組み立ててexecする。
+
+    Args:
+        fields (list): 残すフィールド名のリスト
+
+    Returns:
+        function: entryを受け取り、ID, ENTRYTYPEとfieldsだけを持つ新しい辞書を返す関数
+    """
+    lines = [
+        "def project(entry):",
+        '    e = {"ID": entry["ID"], "ENTRYTYPE": entry["ENTRYTYPE"]}',
+    ]
+    for field in fields:
+        lines.append(f"    if {field!r} in entry:")
+        lines.append(f"        e[{field!r}] = entry[{field!r}]")
+    lines.append("    return e")
+    namespace = {}
+    exec("\n".join(lines), namespace)
+    return namespace["project"]
+
+
+# エントリタイプごとの、必要なフィールドだけを取り出す関数
+_PROJECTORS = {key: _make_projector(value) for key, value in required_fields.items()}
+
+
+# double-hyphen, hyphen, non-breaking hyphen, en dash, em dash, hyphen-minus, minus sign
+# 前にあるものほど優先する（A-1--A-5 のようにページ番号自体にハイフンを含むことがあるため）
+_PAGE_SEPARATORS = ("--", "‐", "‑", "–", "—", "-", "−")
+
+
 def page_double_hyphen(record):
     """
     Separate pages by a double hyphen (--).
@@ -27,37 +61,69 @@ def page_double_hyphen(record):
         dict: the modified record
     """
     if "pages" in record:
-        # double-hyphen, hyphen, non-breaking hyphen, en dash, em dash, hyphen-minus, minus sign
-        separators = ["--", "‐", "‑", "–", "—", "-", "−"]
-        for separator in separators:
-            if separator in record["pages"]:
-                p = [
-                    i.strip().strip(separator)
-                    for i in record["pages"].split(separator, 1)
-                ]
-                record["pages"] = p[0] + "--" + p[-1]
+        pages = record["pages"]
+        for separator in _PAGE_SEPARATORS:
+            first, sep, last = pages.partition(separator)
+            if sep:
+                record["pages"] = (
+                    first.strip().strip(separator)
+                    + "--"
+                    + last.strip().strip(separator)
+                )
                 return record
     return record
 
 
+# authorの区切り（前後の空白の種類や数を問わない）
+_AUTHOR_SEPARATOR_RE = re.compile(r"\s+and\s+")
+
+
+def _split_authors(authors):
+    """authorの文字列を " and " で区切る
+
+    {Barnes and Noble} のように{}の中にあるandでは区切らない。
+
+    Args:
+        authors (str): authorフィールドの中身
+
+    Returns:
+        list: 1人ずつの名前のリスト
+    """
+    names = []
+    start = 0
+    pos = 0
+    depth = 0
+    for m in _AUTHOR_SEPARATOR_RE.finditer(authors):
+        segment = authors[pos : m.start()]
+        depth += segment.count("{") - segment.count("}")
+        pos = m.end()
+        if depth <= 0:
+            names.append(authors[start : m.start()].strip())
+            start = m.end()
+    names.append(authors[start:].strip())
+    return names
+
+
 def split_author(record):
     if "author" in record and record["author"]:
-        record["author"] = [
-            fullname.strip() for fullname in record["author"].split(" and ")
-        ]
+        record["author"] = _split_authors(record["author"])
     return record
 
 
+# 改行を空白に置き換える変換表
+_LINE_BREAK_TABLE = str.maketrans("\n\r", "  ")
+
+
 def remove_line_breaks(record):
     target_fields = ["author", "title", "journal", "booktitle"]
-    table = str.maketrans("\n\r", "  ")
     for key in target_fields:
-        if key in record and isinstance(record[key], str):
-            record[key] = record[key].translate(table)
-        if key in record and isinstance(record[key], list):
+        value = record.get(key)
+        if isinstance(value, str):
+            record[key] = value.translate(_LINE_BREAK_TABLE)
+        elif isinstance(value, list):
             record[key] = [
-                item.translate(table) if isinstance(item, str) else item
-                for item in record[key]
+                item.translate(_LINE_BREAK_TABLE) if isinstance(item, str) else item
+                for item in value
             ]
     return record
 
@@ -76,15 +142,22 @@ class CleanerException(Exception):
 
 def print_required_fields_as_html():
     """Cleanerが残すフィールド定義辞書の中身を出力する"""
-    fd = sys.stdout
-    print("<dl>", file=fd)
+    lines = ["<dl>"]
     for key, value in required_fields.items():
-        print("<dt>%s</dt>" % key, file=fd)
-        for field in value:
-            print("<dd>%s</dd>" % field, file=fd)
-    print("</dl>", file=fd)
+        lines.append("<dt>%s</dt>" % key)
+        lines.extend("<dd>%s</dd>" % field for field in value)
+    lines.append("</dl>")
+    sys.stdout.write("\n".join(lines) + "\n")
+
+
+# ひらがな・カタカナ・半角カタカナ・CJK統合漢字（拡張A〜Hを含む）のコードポイント範囲
+_JAPANESE_RE = re.compile(
+    r"[\u3040-\u30ff\u31f0-\u31ff\u3400-\u4dbf\u4e00-\u9fff\uff65-\uff9f"
+    r"\U00020000-\U0002ebef\U00030000-\U000323af]"
+)
 
 
+@lru_cache(maxsize=4096)
 def _is_japanese(string):
     """文字列が日本語かを判定する
 
@@ -94,15 +167,29 @@ def _is_japanese(string):
     Returns:
         bool: 日本語範囲のUnicodeが1文字でも含まれていればTrueを返す。
     """
-    for c in string:
-        try:
-            name = unicodedata.name(c)
-        except ValueError:
-            # control characterの可能性がある。無視する
-            return False
-        if "CJK UNIFIED" in name or "HIRAGANA" in name or "KATAKANA" in name:
-            return True
-    return False
+    if string.isascii():
+        # ほとんどの英語のauthorはここで判定が終わる
+        return False
+    return _JAPANESE_RE.search(string) is not None
+
+
+@lru_cache(maxsize=4096)
+def _split_name(fullname):
+    """splitnameの結果をauthorの文字列ごとにキャッシュする
+
+    返り値の辞書は呼び出し元で共有されるので変更しないこと。
+
+    Args:
+        fullname (str): authorの名前
+
+    Returns:
+        dict: splitnameの返り値（first, last, von, jr）
+    """
+    return splitname(fullname)
+
+
+# IDに使わない文字（空白・改行・ピリオド・括弧）を取り除く変換表
+_ID_STRIP_TABLE = str.maketrans("", "", " .{}\n\r\t")
 
 
 def _make_id(entry):
@@ -119,7 +206,7 @@ def _make_id(entry):
         return entry["ID"]
 
     first_author = entry["author"][0]
-    name_dict = splitname(first_author)
+    name_dict = _split_name(first_author)
 
     # firstもlastも空ならなにもしない
     if not name_dict["first"] and not name_dict["last"]:
@@ -139,7 +226,7 @@ def _make_id(entry):
         name = "".join(name_dict["last"])
 
     # exclude spaces
-    name = name.replace(" ", "").replace(".", "").replace("{", "").replace("}", "")
+    name = name.translate(_ID_STRIP_TABLE)
     return name + entry["year"]
 
 
@@ -175,64 +262,87 @@ def check_parentheses_matching(string, opening, closing):
 
 
 def _wrap_title(entry):
-    if "title" in entry:
-        title = entry["title"]
-        if (
-            title[0] == "{"
-            and title[-1] == "}"
-            and check_parentheses_matching(title[1:-1], "{", "}")
-        ):
-            # 先頭と末尾にマッチする括弧がすでに存在するのでなにもしない
-            return entry
-        entry["title"] = "{%s}" % entry["title"]
+    title = entry.get("title")
+    if title is not None:
+        last = len(title) - 1
+        if last > 0 and title[0] == "{" and title[last] == "}":
+            # 先頭の{に対応する}が末尾にあるか調べる
+            # 途中で括弧が閉じきった場合は {a}{b} のような形なので包み直す
+            depth = 0
+            for i, c in enumerate(title):
+                if c == "{":
+                    depth += 1
+                elif c == "}":
+                    depth -= 1
+                    if depth == 0:
+                        break
+            if depth == 0 and i == last:
+                # 先頭と末尾にマッチする括弧がすでに存在するのでなにもしない
+                return entry
+        entry["title"] = "{" + title + "}"
     return entry
 
 
+def _treat_japanese_name(fullname, reverse_author: bool):
+    last, sep, first = fullname.partition(",")
+    if sep and _is_japanese(fullname):
+        if reverse_author:
+            return f"{first.strip()} {last.strip()}"
+        return f"{last.strip()} {first.strip()}"
+    # 日本人の名前以外はそのまま
+    return fullname
+
+
 def _treat_japanese_author(entry, reverse_author: bool):
     if "author" in entry:
-        names = []
-        for fullname in entry["author"]:
-            if _is_japanese(fullname) and "," in fullname:
-                last, first = fullname.split(",", 1)
-                first = first.strip()
-                last = last.strip()
-                if reverse_author:
-                    name = f"{first} {last}"
-                else:
-                    name = f"{last} {first}"
-            else:
-                # 日本人の名前以外はそのまま
-                name = fullname
-            names.append(name)
-        entry["author"] = names
+        entry["author"] = [
+            _treat_japanese_name(fullname, reverse_author)
+            for fullname in entry["author"]
+        ]
     return entry
 
 
-def clean_entry(entry, option):
-    # 必要なフィールドだけ取り出す
-    try:
-        needs = required_fields[entry["ENTRYTYPE"]]
-    except KeyError:
-        raise CleanerException(f"Unknown entry type: {entry['ENTRYTYPE']}")
-    e = {}
-    e["ID"] = entry["ID"]
-    e["ENTRYTYPE"] = entry["ENTRYTYPE"]
-    for item in entry.keys():
-        if item in needs:
-            e[item] = entry[item]
+def _replace_id(entry):
+    entry["ID"] = _make_id(entry)
+    return entry
+
+
+def _make_steps(option):
+    """optionに応じて、各entryに順に適用する処理を組み立てる
+
+    optionの判定をentryごとに繰り返さないように、entryを処理する前に一度だけ呼ぶ。
+
+    Args:
+        option (dict): クリーナーの設定
 
+    Returns:
+        tuple: entryを受け取りentryを返す関数のタプル
+    """
+    steps = []
     # 日本人ぽいauthorは姓名のあいだの,を消す
     if option["jauthor"]:
-        e = _treat_japanese_author(e, reverse_author=option["revjauthor"])
-        pass
-
+        steps.append(
+            partial(_treat_japanese_author, reverse_author=option["revjauthor"])
+        )
     # titleを{}でかこむ (caseを保存するため)
     if option["savetitlecase"]:
-        e = _wrap_title(e)
-
+        steps.append(_wrap_title)
     # 引用keyをauthor+yearで置き換える
     if option["replaceid"]:
-        e["ID"] = _make_id(e)
+        steps.append(_replace_id)
+    return tuple(steps)
+
+
+def _clean_entry(entry, steps):
+    # 必要なフィールドだけ取り出す
+    try:
+        project = _PROJECTORS[entry["ENTRYTYPE"]]
+    except KeyError:
+        raise CleanerException(f"Unknown entry type: {entry['ENTRYTYPE']}")
+    e = project(entry)
+
+    for step in steps:
+        e = step(e)
 
     # authorをlistからstrに戻す
     if "author" in e:
@@ -240,6 +350,32 @@ def clean_entry(entry, option):
     return e
 
 
+def clean_entry(entry, option):
+    return _clean_entry(entry, _make_steps(option))
+
+
+_ORD_A = ord("a")
+
+
+def _suffix(n):
+    """重複したIDにつけるsuffixを返す
+
+    a, b, ..., z, aa, ab, ... のようにn番目（0始まり）の文字列を作る。
+
+    Args:
+        n (int): 重複したentryの番号
+
+    Returns:
+        str: suffix
+    """
+    suffix = ""
+    n += 1
+    while n:
+        n, r = divmod(n - 1, 26)
+        suffix = chr(_ORD_A + r) + suffix
+    return suffix
+
+
 def clean_entries(bib_database, option):
     """
     きれいにする
@@ -251,46 +387,132 @@ def clean_entries(bib_database, option):
     Returns:
         BibDatabase:
     """
+    # 整形しながらIDごとにentryをまとめる
+    steps = _make_steps(option)
     cleaned_entries = []
-    for entry in bib_database.entries:
-        e = clean_entry(entry, option)
-        cleaned_entries.append(e)
+    groups = defaultdict(list)
+    for raw_entry in bib_database.entries:
+        entry = _clean_entry(raw_entry, steps)
+        cleaned_entries.append(entry)
+        groups[entry["ID"]].append(entry)
 
     # keyが同じentryをuniqueにする
-    counter = Counter([entry["ID"] for entry in cleaned_entries])
-    for key, count in counter.items():
-        if count >= 2:
-            cnt = 0
-            for entry in cleaned_entries:
-                if entry["ID"] == key:
-                    entry["ID"] = entry["ID"] + chr(ord("a") + cnt)
-                    cnt += 1
+    for key, group in groups.items():
+        if len(group) >= 2:
+            for cnt, entry in enumerate(group):
+                entry["ID"] = key + _suffix(cnt)
+
+    # entryだけを残す（@comment, @preamble, @stringは出力しない）
+    bib_database.entries = cleaned_entries
+    bib_database.comments = []
+    bib_database.preambles = []
+    bib_database.strings.clear()
+    return bib_database
+
+
+# 設定は入力によらないので使い回す
+_WRITER = BibTexWriter()
+_WRITER.indent = "  "
+
+
+_parser_local = threading.local()
+
+
+def _get_parser():
+    """BibTexParserをスレッドごとに使い回す
+
+    BibTexParserは構文定義の組み立てが重いので、作るのはスレッドごとに1回にする。
+    parseの結果は parser.bib_database にたまっていくので、呼ぶたびに新しくする。
+    parseが終わったら呼び出し側で parser.bib_database を手放すこと。
+
+    Returns:
+        BibTexParser: 空のBibDatabaseを持つparser
+    """
+    parser = getattr(_parser_local, "parser", None)
+    if parser is None:
+        parser = BibTexParser(customization=parser_customizations)
+        parser.expect_multiple_parse = True
+        _parser_local.parser = parser
+    parser.bib_database = BibDatabase()
+    if parser.common_strings:
+        parser.bib_database.load_common_strings()
+    return parser
+
+
+def _iter_clean_bibtex(bibtext, option):
+    parser = _get_parser()
+    try:
+        if isinstance(bibtext, str):
+            bib_database = bibtexparser.loads(bibtext, parser=parser)
+        else:
+            bib_database = bibtexparser.load(bibtext, parser=parser)
+    finally:
+        # 次の呼び出しまで結果を抱え込まないように、parserからは手放す
+        parser.bib_database = None
+    cleaned_database = clean_entries(bib_database, option)
+
+    # BibTexWriter.writeと同じ順序・区切りでentryを1つずつ書き出す
+    entries = sorted(
+        cleaned_database.entries,
+        key=lambda x: BibDatabase.entry_sort_key(x, _WRITER.order_entries_by),
+    )
+    for i, entry in enumerate(entries):
+        if i > 0:
+            yield _WRITER.entry_separator
+        yield _WRITER._entry_to_bibtex(entry)
+
 
-    # make new db
-    db = BibDatabase()
-    db.entries = cleaned_entries
-    return db
+# これより長い入力は結果をキャッシュせず、entryごとに書き出す
+# （キャッシュが抱える文字列は最大でも32組 x 64KiB程度に収まる）
+_CACHE_MAX_LENGTH = 64 * 1024
+
+
+@lru_cache(maxsize=32)
+def _cached_clean_bibtex(bibtext, option_items):
+    """同じ入力と設定の組み合わせの整形結果をキャッシュする
+
+    Args:
+        bibtext (str): BibTexの文字列
+        option_items (tuple): クリーナーの設定を (key, value) の組にしてソートしたもの
+
+    Returns:
+        str: 整形されたBibTex
+    """
+    return "".join(_iter_clean_bibtex(bibtext, dict(option_items)))
+
+
+def iter_bibtex_cleaner(bibtext, option):
+    """BibTeXを読み込み、きれいな形に整形したものを少しずつ返す
+
+    出力全体を1つの文字列にせず、entryごとに書き出す。
+    IDの重複を解消するため、読み込みと整形は最初の要素を返す前にすべて終わらせる。
+    64KiB以下の文字列の入力は結果をキャッシュし、同じ入力と設定なら整形をやり直さずに
+    全体を1つの断片として返す。
+
+    Args:
+        bibtext (str or file): BibTexの文字列、またはBibTexを読み出せるファイルオブジェクト
+        option (dict): クリーナーの設定
+
+    Yields:
+        str: 整形されたBibTexの断片。順につなげるとbibtex_cleanerの返り値と同じになる
+    """
+    if isinstance(bibtext, str) and len(bibtext) <= _CACHE_MAX_LENGTH:
+        yield _cached_clean_bibtex(bibtext, tuple(sorted(option.items())))
+    else:
+        yield from _iter_clean_bibtex(bibtext, option)
 
 
 def bibtex_cleaner(bibtext, option):
     """BibTeXを読み込み、きれいな形に整形して返す
 
     Args:
-        bibtext (str): BibTexの文字列
+        bibtext (str or file): BibTexの文字列、またはBibTexを読み出せるファイルオブジェクト
         option (dict): クリーナーの設定
 
     Returns:
         str: 整形されたBibTex
     """
-    try:
-        parser = BibTexParser(customization=parser_customizations)
-        bib_database = bibtexparser.loads(bibtext, parser=parser)
-        cleaned_database = clean_entries(bib_database, option)
-        writer = BibTexWriter()
-        writer.indent = "  "
-        return writer.write(cleaned_database)
-    except CleanerException as e:
-        raise
+    return "".join(iter_bibtex_cleaner(bibtext, option))
 
 
 def parse_args():
@@ -316,5 +538,11 @@ def parse_args():
 
 if __name__ == "__main__":
     args = parse_args()
-    bibtex_str = args.bibfile.read()
-    args.outfile.write(bibtex_cleaner(bibtex_str))
+    # Webフォームの初期設定と同じ
+    option = {
+        "savetitlecase": False,
+        "replaceid": True,
+        "jauthor": True,
+        "revjauthor": False,
+    }
+    args.outfile.writelines(iter_bibtex_cleaner(args.bibfile, option))
@@ -1,13 +1,26 @@
 # coding: utf-8
 
-from flask import Flask, render_template, request, Response, abort
-from cleaner import bibtex_cleaner, CleanerException
+from itertools import chain
+
+from flask import (
+    Flask,
+    render_template,
+    request,
+    Response,
+    abort,
+    stream_with_context,
+)
+from cleaner import iter_bibtex_cleaner, CleanerException
 
 app = Flask(__name__)
+# これより大きいリクエストはパースする前に413で断る
+# フォームはmultipart/form-dataで送られるので、テキスト欄の上限もそろえる
+app.config["MAX_CONTENT_LENGTH"] = 32 * 1024 * 1024
+app.config["MAX_FORM_MEMORY_SIZE"] = 32 * 1024 * 1024
 
 
 class Setting:
-    items = ["savetitlecase", "replaceid", "jauthor", "revjauthor"]
+    items = ("savetitlecase", "replaceid", "jauthor", "revjauthor")
 
 
 @app.route("/")
@@ -33,22 +46,29 @@ def clean():
             return Response("Error. 入力が空です", mimetype="text/plain")
 
         # 設定を取り出す
-        option = {}
-        for opt in Setting.items:
-            if request.form.get(opt) == "on":
-                option[opt] = True
-            else:
-                option[opt] = False
+        form = request.form
+        option = {opt: form.get(opt) == "on" for opt in Setting.items}
 
+        # 読み込みと整形は最初の断片を取り出す時点で終わるので、エラーはここで捕まえられる
         try:
-            cleaned = bibtex_cleaner(bibtext, option)
-        except CleanerException as e:
+            chunks = iter_bibtex_cleaner(bibtext, option)
+            first = next(chunks, "")
+        except CleanerException:
             return Response(
                 "Error. 入力形式はbibtexですか？（または変換プログラムのバグの可能性があります）\n",
                 mimetype="text/plain",
             )
 
-        return Response(cleaned, mimetype="text/plain")
+        return Response(
+            stream_with_context(chain([first], chunks)), mimetype="text/plain"
+        )
+
+
+@app.errorhandler(413)
+def request_entity_too_large(e):
+    return Response(
+        "Error. 入力が大きすぎます（32MBまで）\n", status=413, mimetype="text/plain"
+    )
 
 
 @app.route("/healthz")
@@ -0,0 +1,82 @@
+# coding: utf-8
+import pytest
+from bibtexparser.bibdatabase import UndefinedString
+
+import cleaner
+from cleaner import bibtex_cleaner, page_double_hyphen
+
+OPTION = {
+    "savetitlecase": False,
+    "replaceid": True,
+    "jauthor": True,
+    "revjauthor": False,
+}
+
+
+def test_page_double_hyphen_keeps_hyphenated_page_numbers():
+    # ページ番号自体のハイフンでは区切らない
+    assert page_double_hyphen({"pages": "A-1--A-5"})["pages"] == "A-1--A-5"
+    assert page_double_hyphen({"pages": "1-1–1-5"})["pages"] == "1-1--1-5"
+
+
+def test_page_double_hyphen_normalizes_separators():
+    assert page_double_hyphen({"pages": "12 – 15"})["pages"] == "12--15"
+    assert page_double_hyphen({"pages": "5-7"})["pages"] == "5--7"
+    assert page_double_hyphen({"pages": "e1−e9"})["pages"] == "e1--e9"
+    assert page_double_hyphen({"pages": "100"})["pages"] == "100"
+
+
+def test_parser_does_not_keep_previous_input():
+    first = (
+        '@string{foo = "Foo Journal"}\n'
+        "@article{first, author = {A, B}, title = {T}, journal = foo, year = {2000}}\n"
+    )
+    second = "@article{second, author = {C, D}, title = {U}, journal = {J}, year = {2001}}\n"
+    assert "Foo Journal" in bibtex_cleaner(first, OPTION)
+    # 使い回しているparserが前回の結果を抱え込んでいない
+    assert cleaner._parser_local.parser.bib_database is None
+
+    cleaned = bibtex_cleaner(second, OPTION)
+    assert "@article{C2001," in cleaned
+    assert "A2000" not in cleaned
+
+    # 前回の@stringは引き継がれない
+    macro_only = second.replace("{J}", "foo")
+    with pytest.raises(UndefinedString):
+        bibtex_cleaner(macro_only, OPTION)
+
+
+def test_suffix_continues_after_z():
+    assert [cleaner._suffix(n) for n in (0, 25, 26, 27)] == ["a", "z", "aa", "ab"]
+
+
+def test_many_duplicate_ids_get_alphabetic_suffixes():
+    bibtext = "".join(
+        "@article{d%d, author = {Lee, K.}, title = {T%d}, journal = {J}, year = {2015}}\n"
+        % (i, i)
+        for i in range(30)
+    )
+    cleaned = bibtex_cleaner(bibtext, OPTION)
+    ids = [
+        line[len("@article{") : -1]
+        for line in cleaned.splitlines()
+        if line.startswith("@article{")
+    ]
+    assert len(ids) == 30
+    assert len(set(ids)) == 30
+    for entry_id in ids:
+        assert entry_id.startswith("Lee2015")
+        suffix = entry_id[len("Lee2015") :]
+        assert suffix.isalpha() and suffix.islower()
+
+
+def test_split_author_accepts_any_whitespace_around_and():
+    record = cleaner.split_author({"author": "A, B\tand C, D  and E, F"})
+    assert record["author"] == ["A, B", "C, D", "E, F"]
+
+
+def test_split_author_does_not_split_inside_names():
+    record = cleaner.split_author({"author": "Strandberg, B. and Brandon, A."})
+    assert record["author"] == ["Strandberg, B.", "Brandon, A."]
+    record = cleaner.split_author({"author": "{Barnes and Noble} and Smith, J."})
+    assert record["author"] == ["{Barnes and Noble}", "Smith, J."]